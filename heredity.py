@@ -1,5 +1,7 @@
 import csv
 import itertools
+import math
+import os
 import sys
 
 PROBS = {
@@ -36,6 +38,13 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Gene count of the ghost parent that founders are given, stored after
+# everyone else so that a parent index of -1 refers to it
+GHOST_GENES = (0,)
+
+# Pedigrees with at least this many people are enumerated in parallel
+PARALLEL_PEOPLE = 10
+
 
 def main():
     # Check for proper usage
@@ -43,53 +52,139 @@ def main():
         sys.exit("Usage: python heredity.py data.csv")
     people = load_data(sys.argv[1])
 
+    # Compute gene and trait probabilities for each person
+    probabilities = compute_probabilities(people)
+
+    # Print results
+    for person in people:
+        print(f"{person}:")
+        for field in probabilities[person]:
+            print(f"  {field.capitalize()}:")
+            for value in probabilities[person][field]:
+                p = probabilities[person][field][value]
+                print(f"    {value}: {p:.4f}")
+
+
+def compute_probabilities(people):
+    """
+    Return the gene and trait distributions for each person in `people`,
+    conditioned on the traits that are known.
+
+    Only gene assignments are enumerated. A known trait is fixed by the
+    evidence, and an unknown trait depends on nothing but the person's own
+    gene count, so it is summed out directly instead of being enumerated.
+    """
+
+    # Code people by index so the inner loop avoids name lookups
+    names, mother, father, traits = index_people(people)
+    tables = probability_tables()
+    factors = factor_tables(traits, mother, father, tables)
+    weights = trait_weights(traits, tables)
+
+    # Scale every joint probability by the same bound on its logarithm so
+    # that large pedigrees do not underflow; normalizing removes the scale.
+    # A bound of -inf means the evidence is impossible, so leave it unscaled
+    log_scale = sum(largest(table) for table in factors)
+    if log_scale == -math.inf:
+        log_scale = 0
+    args = (weights, factors, mother, father, log_scale)
+
+    # Split large pedigrees across processes by fixing the first few digits
+    # of the gene assignment; each process sums its own share
+    workers = os.cpu_count() or 1
+    if len(names) < PARALLEL_PEOPLE or workers == 1:
+        gene_totals, trait_totals = enumerate_genes((), *args)
+    else:
+        # Imported here so that small pedigrees do not pay for it on startup
+        import multiprocessing
+
+        split = 1
+        while 3 ** split < 4 * workers and split < len(names):
+            split += 1
+        prefixes = itertools.product(range(3), repeat=split)
+        with multiprocessing.Pool(workers) as pool:
+            parts = pool.starmap(
+                enumerate_genes, [(prefix,) + args for prefix in prefixes]
+            )
+        gene_totals = [
+            [math.fsum(part[0][i][g] for part in parts) for g in range(3)]
+            for i in range(len(names))
+        ]
+        trait_totals = [
+            [math.fsum(part[1][i][t] for part in parts) for t in range(2)]
+            for i in range(len(names))
+        ]
+
     # Keep track of gene and trait probabilities for each person
     probabilities = {
         person: {
             "gene": {
-                2: 0,
-                1: 0,
-                0: 0
+                2: gene_totals[i][2],
+                1: gene_totals[i][1],
+                0: gene_totals[i][0]
             },
             "trait": {
-                True: 0,
-                False: 0
+                True: trait_totals[i][True],
+                False: trait_totals[i][False]
             }
         }
-        for person in people
+        for i, person in enumerate(names)
     }
 
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
-
     # Ensure probabilities sum to 1
     normalize(probabilities)
+    return probabilities
 
-    # Print results
-    for person in people:
-        print(f"{person}:")
-        for field in probabilities[person]:
-            print(f"  {field.capitalize()}:")
-            for value in probabilities[person][field]:
-                p = probabilities[person][field][value]
-                print(f"    {value}: {p:.4f}")
+
+def enumerate_genes(prefix, weights, factors, mother, father, log_scale):
+    """
+    Return the unnormalized gene and trait totals summed over every gene
+    assignment whose leading digits are `prefix`, with each joint
+    probability divided by exp(`log_scale`).
+
+    `gene_totals[i][g]` is the total for person i having g copies of the
+    gene and `trait_totals[i][t]` the total for their trait being `t`.
+    """
+    gene_totals = [[0, 0, 0] for _ in factors]
+    trait_totals = [[0, 0] for _ in factors]
+
+    # Loop over every gene assignment as a base-3 counter whose digit i is
+    # the number of gene copies of person i; the prefix and the ghost are
+    # digits with a single choice, so each tuple is built in one step
+    digits = (
+        [(g,) for g in prefix]
+        + [range(3)] * (len(factors) - len(prefix))
+        + [GHOST_GENES]
+    )
+    for genes in itertools.product(*digits):
+        p = coded_probability(genes, factors, mother, father, log_scale)
+
+        # Add p to each person's gene count and share it out over their
+        # trait, stopping before the ghost at the end of `genes`
+        for i in range(len(factors)):
+            g = genes[i]
+            gene_totals[i][g] += p
+            share = weights[i][g]
+            trait_totals[i][0] += p * share[0]
+            trait_totals[i][1] += p * share[1]
+    return gene_totals, trait_totals
+
+
+def trait_weights(traits, tables):
+    """
+    Return, for each person and number of genes, the share of a joint
+    probability that goes to their trait being False and True. A known
+    trait takes all of it; an unknown trait is split by its distribution
+    in `tables` from `probability_tables`.
+    """
+    _, p_trait, _ = tables
+    return [
+        tuple(
+            p_trait[g] if trait == -1 else (1 - trait, trait)
+            for g in range(3)
+        )
+        for trait in traits
+    ]
 
 
 def load_data(filename):
@@ -116,14 +211,13 @@ def load_data(filename):
 
 def powerset(s):
     """
-    Return a list of all possible subsets of set s.
+    Yield all possible subsets of set s, one at a time, as frozensets.
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    items = tuple(s)
+    for subset in itertools.chain.from_iterable(
+        itertools.combinations(items, r) for r in range(len(items) + 1)
+    ):
+        yield frozenset(subset)
 
 
 def joint_probability(people, one_gene, two_genes, have_trait):
@@ -138,55 +232,207 @@ def joint_probability(people, one_gene, two_genes, have_trait):
         * everyone not in set` have_trait` does not have the trait.
     """
 
-    # Parse the input into cases for each person
-    genes = dict()
-    trait = dict()
-    for person in people:
-        if person in one_gene:
-            genes[person] = 1
-        elif person in two_genes:
-            genes[person] = 2
-        else:
-            genes[person] = 0
-        if person in have_trait:
-            trait[person] = True
-        else:
-            trait[person] = False
-
-    p_list = dict()
-    for person in people:
-        if people[person]['mother'] is None and people[person]['father'] is None: # Person does not have parents
-            p_gene = PROBS['gene'][genes[person]]
-            p_trait = PROBS['trait'][genes[person]][trait[person]]
-            p = p_gene * p_trait
-        else:  # If person has parents
-            parent_genes = dict()
-            p_parents = dict()  # Probability of getting one gene from the parent
-            for parent in ('father', 'mother'):
-                parent_genes[parent] = genes[people[person][parent]]
-                if parent_genes[parent] == 1:
-                    p_parents[parent] = 0.5 * (1 - PROBS['mutation'])+0.5*PROBS['mutation'] # 1 of the 2 genes is passed on randomly with prob = 0.5
-                elif parent_genes[parent] == 2:
-                    p_parents[parent] = 1 - PROBS['mutation']
-                else: # I.e., parent does not have the gene
-                    p_parents[parent] = PROBS['mutation']
-            if genes[person] == 1:  # Gene either from mother or father, but not both
-                p_gene = p_parents['father'] * (1 - p_parents['mother']) + p_parents['mother'] * (
-                        1 - p_parents['father'])
-            elif genes[person] == 2:  # Gene from both mother AND father
-                p_gene = p_parents['father'] * p_parents['mother']
-            elif genes[person] == 0:  # No gene from either mother OR father = NOT father AND NOT Mother
-                p_gene = (1 - p_parents['father']) * (1 - p_parents['mother'])
-
-            p_trait = PROBS['trait'][genes[person]][trait[person]]
-            p = p_gene * p_trait
-        p_list[person] = p
+    # Only N factors are needed, so compute them directly from PROBS
+    # rather than building the tables that the full enumeration uses
+    p_gene, p_trait, p_pass = probability_values()
+    genes = {
+        person: 1 if person in one_gene else 2 if person in two_genes else 0
+        for person in people
+    }
     joint_p = 1
-    for p in p_list.values():
-        joint_p = joint_p * p
+    for person, row in people.items():
+        if not has_parents(people, person):
+            p = p_gene[genes[person]]
+        else:
+            p = inheritance_probability(
+                genes[person],
+                p_pass[genes[row["mother"]]],
+                p_pass[genes[row["father"]]]
+            )
+        joint_p *= p * p_trait[genes[person]][person in have_trait]
     return joint_p
 
 
+def has_parents(people, person):
+    """
+    Return True if `person` in `people` has a mother and father, and False
+    if they have neither. Raise ValueError if only one of them is given.
+    """
+    mother = people[person]["mother"]
+    father = people[person]["father"]
+    if (mother is None) != (father is None):
+        raise ValueError(
+            f"{person} must have both a mother and a father, or neither"
+        )
+    return mother is not None
+
+
+def index_people(people):
+    """
+    Return the names in `people` as a list, together with parallel lists
+    giving the index of each person's mother and father in that list
+    (-1 if unknown) and their trait as 1 or 0 (-1 if unknown).
+    """
+    names = list(people)
+    index = {name: i for i, name in enumerate(names)}
+    for name in names:
+        has_parents(people, name)
+
+    # A parent name missing from `people` raises KeyError, as a lookup by
+    # name would; only a blank parent becomes -1
+    def parent_index(parent):
+        return -1 if parent is None else index[parent]
+
+    mother = [parent_index(people[name]["mother"]) for name in names]
+    father = [parent_index(people[name]["father"]) for name in names]
+    traits = [
+        -1 if people[name]["trait"] is None else int(people[name]["trait"])
+        for name in names
+    ]
+    return names, mother, father, traits
+
+
+def coded_probability(genes, factors, mother, father, log_scale=0):
+    """
+    Compute and return a joint probability for people coded by index,
+    divided by exp(`log_scale`).
+
+    `genes[i]` is the number of gene copies of person i, `factors[i]` their
+    table from `factor_tables`, and `mother[i]` and `father[i]` the indices
+    of their parents, or -1. Factors are added as logarithms, so the
+    product of many small probabilities does not underflow along the way.
+
+    `genes` ends with `GHOST_GENES`, so a founder's parent index of -1
+    refers to a ghost parent with no copies of the gene, and every person
+    is looked up in the same way.
+    """
+    log_p = 0
+    for i in range(len(factors)):
+        log_p += factors[i][genes[i]][genes[mother[i]]][genes[father[i]]]
+    if log_p == -math.inf:  # Impossible assignment
+        return 0
+    return math.exp(log_p - log_scale)
+
+
+def probability_values():
+    """
+    Return PROBS as tuples indexed by number of genes, with trait as 0 or 1.
+
+    The tuples are `p_gene[g]`, `p_trait[g][t]` and `p_pass[g]`, the
+    probability that a parent with g genes passes one on. They are read
+    from PROBS on every call, so changes to PROBS take effect in the next
+    computation.
+    """
+    p_gene = tuple(PROBS["gene"][g] for g in range(3))
+    p_trait = tuple(
+        (PROBS["trait"][g][False], PROBS["trait"][g][True]) for g in range(3)
+    )
+
+    # A parent with one copy passes it on randomly with prob = 0.5
+    mutation = PROBS["mutation"]
+    p_pass = (mutation, 0.5 * (1 - mutation) + 0.5 * mutation, 1 - mutation)
+    return p_gene, p_trait, p_pass
+
+
+def inheritance_probability(child_genes, p_mother, p_father):
+    """
+    Return the probability that a child has `child_genes` copies of the gene
+    given the probabilities that their mother and father pass one on.
+    """
+    if child_genes == 1:  # Gene either from mother or father, but not both
+        return p_father * (1 - p_mother) + p_mother * (1 - p_father)
+    elif child_genes == 2:  # Gene from both mother AND father
+        return p_father * p_mother
+    else:  # No gene from either mother OR father = NOT father AND NOT Mother
+        return (1 - p_father) * (1 - p_mother)
+
+
+def probability_tables():
+    """
+    Return `p_gene` and `p_trait` from `probability_values`, together with
+    `transmit[g][mg][fg]`, the probability that a child has g genes given
+    that their mother has mg and their father fg.
+    """
+    p_gene, p_trait, p_pass = probability_values()
+    transmit = tuple(
+        tuple(
+            tuple(
+                inheritance_probability(g, p_pass[mg], p_pass[fg])
+                for fg in range(3)
+            )
+            for mg in range(3)
+        )
+        for g in range(3)
+    )
+    return p_gene, p_trait, transmit
+
+
+def factor_tables(traits, mother, father, tables):
+    """
+    Return the log-probability table of each person, given their trait in
+    `traits` (-1 if unknown), the indices of their parents in `mother` and
+    `father` (-1 if unknown) and `tables` from `probability_tables`.
+
+    A table depends only on the trait and whether the person has parents,
+    so each distinct table is built once per call and shared.
+    """
+    cache = dict()
+    factors = []
+    for i, trait in enumerate(traits):
+        key = (trait, mother[i] != -1 and father[i] != -1)
+        if key not in cache:
+            cache[key] = person_factor(*key, tables)
+        factors.append(cache[key])
+    return factors
+
+
+def person_factor(trait, has_parents, tables):
+    """
+    Return a table of the log-probability that a person has a number of
+    genes and the given `trait` (1 or 0), where a `trait` of -1 is summed
+    out, using `tables` from `probability_tables`.
+
+    The table is indexed by the person's number of genes and then by the
+    number of genes of their mother and father. If `has_parents` is false,
+    both parents are ghosts with no genes, so only index 0 exists for them.
+    """
+    p_gene, p_trait, transmit = tables
+
+    def trait_factor(genes):
+        return 1 if trait == -1 else p_trait[genes][trait]
+
+    if not has_parents:
+        return tuple(
+            ((log(p_gene[g] * trait_factor(g)),),) for g in range(3)
+        )
+    return tuple(
+        tuple(
+            tuple(
+                log(transmit[g][mg][fg] * trait_factor(g))
+                for fg in range(3)
+            )
+            for mg in range(3)
+        )
+        for g in range(3)
+    )
+
+
+def log(p):
+    """
+    Return the natural logarithm of probability `p`, or -inf if `p` is 0.
+    """
+    return math.log(p) if p > 0 else -math.inf
+
+
+def largest(table):
+    """
+    Return the largest entry of a table of nested tuples.
+    """
+    if isinstance(table, tuple):
+        return max(largest(entry) for entry in table)
+    return table
+
+
 def update(probabilities, one_gene, two_genes, have_trait, p):
     """
     Add to `probabilities` a new joint probability `p`.
@@ -195,22 +441,21 @@ def update(probabilities, one_gene, two_genes, have_trait, p):
     the person is in `have_gene` and `have_trait`, respectively.
     """
 
-    # Update for each person
-    for person in probabilities:
+    # Update for each person, looking up their distributions only once
+    for person, distributions in probabilities.items():
+        gene = distributions["gene"]
+        trait = distributions["trait"]
 
         #Add probabilities for one gene, 2 genes or no genes
         if person in one_gene:
-            probabilities[person]["gene"][1] += p
+            gene[1] += p
         elif person in two_genes:
-            probabilities[person]["gene"][2] += p
+            gene[2] += p
         else:
-            probabilities[person]["gene"][0] += p
+            gene[0] += p
 
         # Add probabilities for Trait
-        if person in have_trait:
-            probabilities[person]['trait'][True] += p
-        else:
-            probabilities[person]['trait'][False] += p
+        trait[person in have_trait] += p
 
 def normalize(probabilities):
     """
@@ -218,33 +463,20 @@ def normalize(probabilities):
     is normalized (i.e., sums to 1, with relative proportions the same).
     """
 
-    #Make the update for each person
+    # Make the update for each person
     for person in probabilities:
 
-    # Update 'gene' probability distribution
-        # Get the sum of all gene values
-        gene_sum=sum(probabilities[person]['gene'].values())
-        if gene_sum==0:
-            continue
-        else:
-            probabilities[person]['gene'][1]=probabilities[person]['gene'][1]/gene_sum
-            probabilities[person]['gene'][2] = probabilities[person]['gene'][2] / gene_sum
-            probabilities[person]['gene'][0] = probabilities[person]['gene'][0] / gene_sum
-
-    # Update 'trait' probability distribution
-        # Get the sum of all gene values
-        trait_sum = sum(probabilities[person]['trait'].values())
-        if trait_sum==0:
-            continue
-        else:
-            probabilities[person]['trait'][True] = probabilities[person]['trait'][True] / gene_sum
-            probabilities[person]['trait'][False] = probabilities[person]['trait'][False] / gene_sum
+        # Divide the 'gene' and 'trait' distributions by their own sums,
+        # leaving a distribution that sums to 0 unchanged
+        for field in probabilities[person]:
+            distribution = probabilities[person][field]
+            total = math.fsum(distribution.values())
+            if total == 0:
+                continue
+            for value in distribution:
+                distribution[value] /= total
 
 if __name__ == "__main__":
     main()
-    test_people={'Harry': {'name': 'Harry', 'mother': 'Lily', 'father': 'James', 'trait': None},
-              'James': {'name': 'James', 'mother': None, 'father': None, 'trait': True},
-              'Lily': {'name': 'Lily', 'mother': None, 'father': None, 'trait': False}}
-    joint_probability(test_people, {"Harry"}, {"James"}, {"James"})
 
 